@@ -25,6 +25,16 @@ import binascii
 import struct
 import argparse
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 
 PROTOCOL_89 = "89"
 PROTOCOL_12C5A = "12c5a"
@@ -37,7 +47,13 @@ PROTOSET_12B = [PROTOCOL_12C52, PROTOCOL_12Cx052]
 PROTOSET_PARITY = [PROTOCOL_12C5A, PROTOCOL_12C52]
 
 
-class Programmer:
+class Programmer(object):
+    # Many sessions may run side by side on one host, so keep the
+    # per-session state small
+    __slots__ = ("conn", "protocol", "chkmode",
+                 "fosc", "info", "version", "model", "name", "romsize",
+                 "baudrate")
+
     def __init__(self, conn, protocol=None):
         self.conn = conn
         self.protocol = protocol
@@ -56,7 +72,8 @@ class Programmer:
             s = bytearray(self.conn.read(size - len(buf)))
             buf += s
 
-            logging.debug("recv: " + " ".join(["%02X" % i for i in s]))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("recv: " + " ".join(["%02X" % i for i in s]))
 
             if len(s) == 0:
                 raise IOError()
@@ -64,7 +81,8 @@ class Programmer:
         return list(buf)
 
     def __conn_write(self, s):
-        logging.debug("send: " + " ".join(["%02X" % i for i in s]))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("send: " + " ".join(["%02X" % i for i in s]))
 
         self.conn.write(bytearray(s))
 
@@ -231,14 +249,22 @@ class Programmer:
 
         self.__conn_write(buf)
 
-    def detect(self):
+    def detect(self, timeout=None):
+        if timeout is not None:
+            timeout += time.time()
+
         for i in range(1000):
             try:
                 self.__conn_write([0x7F, 0x7F])
                 cmd, dat = self.recv(0.015, [0x68])
+                # Timing samples, then at least version and model ID
+                if len(dat) < 16 + 5:
+                    logging.debug("detect(..): Incomplete target info")
+                    raise IOError()
                 break
             except IOError:
-                pass
+                if timeout is not None and time.time() >= timeout:
+                    raise
         else:
             raise IOError()
 
@@ -411,18 +437,25 @@ class Programmer:
                 logging.info("Serial number: "
                              + " ".join(["%02X" % j for j in dat]))
 
+    # The image is read one block at a time, without making a padded
+    # copy of it, so all sessions can share one image
     def flash(self, code):
-        code = list(code) + [0x00] * (511 - (len(code) - 1) % 512)
+        size = len(code) + 511 - (len(code) - 1) % 512
 
-        for i in range(0, len(code), 128):
+        for i in range(0, size, 128):
             logging.info("Flash code region (%04X, %04X)" % (i, i + 127))
 
-            addr = [0, 0, i >> 8, i & 0xFF, 0, 128]
-            self.send(0x00, addr + code[i:i+128])
+            block = bytearray(code[i:i+128])
+            if len(block) < 128:
+                block += bytearray(128 - len(block))
+
+            buf = [0, 0, i >> 8, i & 0xFF, 0, 128]
+            buf += block
+            self.send(0x00, buf)
             cmd, dat = self.recv()
-            assert dat[0] == sum(code[i:i+128]) % 256
+            assert dat[0] == sum(block) % 256
 
-            yield (i + 128.0) / len(code)
+            yield (i + 128.0) / size
 
     def options(self, **kwargs):
         erase_eeprom = kwargs.get("erase_eeprom", None)
@@ -490,32 +523,72 @@ class Programmer:
             assert cmd == 0x8D and not dat
 
 
-def autoisp(conn, baud, magic):
-    if not magic:
-        return
+# Ask the running firmware to reboot into ISP mode, either by sending
+# the magic word or by pulsing DTR/RTS, and start detecting right away.
+# The trigger is repeated every `interval` seconds, at most `retries`
+# times.  Returns the time from the last trigger to the bootloader
+# answering.
+def autoisp(prog, baud, magic, reset=None, retries=5, interval=0.5):
+    conn = prog.conn
+    bak = (conn.baudrate, conn.parity)
+
+    for attempt in range(1, retries + 1):
+        if reset is not None:
+            logging.info("AutoISP attempt %d: pulse %s" % (attempt, reset))
+            # pySerial opens the port with DTR/RTS asserted, so deassert
+            # the line first to get a real edge, and leave it asserted
+            setline = {"dtr": conn.setDTR, "rts": conn.setRTS}[reset]
+            setline(False)
+            time.sleep(0.1)
+            setline(True)
+            time.sleep(0.1)
+
+        if magic:
+            logging.info("AutoISP attempt %d: send magic at baudrate %d"
+                         % (attempt, baud))
+            conn.baudrate = baud
+            conn.parity = serial.PARITY_NONE
+            conn.write(bytearray(ord(i) for i in magic))
+            conn.flush()
+            # flush() may return before a USB adapter has sent everything,
+            # so wait for the magic word to be on the wire (10 bits per
+            # byte) before changing the baudrate back
+            time.sleep(len(magic) * 10.0 / baud + 0.02)
+            conn.baudrate, conn.parity = bak
+
+        conn.flushInput()
+        start = time.time()
+
+        try:
+            prog.detect(interval)
+        except IOError:
+            logging.info("AutoISP attempt %d: no response" % attempt)
+            continue
 
-    bak = conn.baudrate
-    conn.baudrate = baud
-    conn.write(bytearray(ord(i) for i in magic))
-    conn.flush()
-    time.sleep(0.5)
-    conn.baudrate = bak
+        elapsed = time.time() - start
+        logging.info("Time to bootloader: %.3fs (attempt %d)"
+                     % (elapsed, attempt))
+        return elapsed
 
+    raise IOError("AutoISP failed after %d attempts" % retries)
 
-def program(prog, code, erase_eeprom=None):
+
+def program(prog, code, erase_eeprom=None, aisp=None, options_only=False):
     sys.stdout.write("Detecting target...")
     sys.stdout.flush()
 
-    prog.detect()
-
-    print(" done")
+    if aisp is None:
+        prog.detect()
+        print(" done")
+    else:
+        print(" done (%.3fs)" % aisp(prog))
 
     prog.print_info()
 
     if prog.protocol is None:
         raise IOError("Unsupported target")
 
-    if code is None:
+    if code is None and not options_only:
         return
 
     prog.unknown_packet_1()
@@ -529,27 +602,28 @@ def program(prog, code, erase_eeprom=None):
 
     prog.unknown_packet_2()
 
-    sys.stdout.write("Erasing target...")
-    sys.stdout.flush()
-
-    prog.erase()
+    if not options_only:
+        sys.stdout.write("Erasing target...")
+        sys.stdout.flush()
 
-    print(" done")
+        prog.erase()
 
-    print("Size of the binary: %d" % len(code))
+        print(" done")
 
-    # print("Programming: ", end="", flush=True)
-    sys.stdout.write("Programming: ")
-    sys.stdout.flush()
+        print("Size of the binary: %d" % len(code))
 
-    oldbar = 0
-    for progress in prog.flash(code):
-        bar = int(progress * 20)
-        sys.stdout.write("#" * (bar - oldbar))
+        # print("Programming: ", end="", flush=True)
+        sys.stdout.write("Programming: ")
         sys.stdout.flush()
-        oldbar = bar
 
-    print(" done")
+        oldbar = 0
+        for progress in prog.flash(code):
+            bar = int(progress * 20)
+            sys.stdout.write("#" * (bar - oldbar))
+            sys.stdout.flush()
+            oldbar = bar
+
+        print(" done")
 
     prog.unknown_packet_3()
 
@@ -564,6 +638,17 @@ def program(prog, code, erase_eeprom=None):
     prog.terminate()
 
 
+# Peak resident set size of this process in KB, or None if unknown
+def maxrss():
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+
 # Convert Intel HEX code to binary format
 def hex2bin(code):
     buf = bytearray()
@@ -646,6 +731,18 @@ def main():
                         default=4800)
     parser.add_argument("-m", "--aispmagic",
                         help="magic word for AutoISP")
+    parser.add_argument("--aispreset",
+                        help="pulse DTR or RTS to reset target for AutoISP",
+                        choices=["dtr", "rts"])
+    parser.add_argument("--aispretry",
+                        help="number of AutoISP attempts (default: 5)",
+                        type=int,
+                        default=5)
+    parser.add_argument("--aispwait",
+                        help=("seconds to wait for the bootloader after "
+                              + "each AutoISP attempt (default: 0.5)"),
+                        type=float,
+                        default=0.5)
     parser.add_argument("-v", "--verbose",
                         help="be verbose",
                         default=0,
@@ -658,6 +755,15 @@ def main():
                         help=("do not erase data eeprom next download"
                               +"(experimental)"),
                         action="store_true")
+    parser.add_argument("-o", "--options_only",
+                        help=("only set options, without erasing or "
+                              + "programming the target"),
+                        action="store_true")
+    parser.add_argument("-b", "--batch",
+                        help=("number of targets to process in turn "
+                              + "(default: 1)"),
+                        type=int,
+                        default=1)
 
     opts = parser.parse_args()
 
@@ -674,16 +780,31 @@ def main():
     if not opts.erase_eeprom and not opts.not_erase_eeprom:
         opts.erase_eeprom = None
 
+    if opts.options_only:
+        if opts.image:
+            parser.error("no image can be given with --options_only")
+        if opts.erase_eeprom is None:
+            parser.error("--options_only needs an option to set (-e/-ne)")
+
+    if opts.aispretry < 1:
+        parser.error("--aispretry must be at least 1")
+    if opts.aispwait <= 0:
+        parser.error("--aispwait must be positive")
+
+    if opts.batch < 1:
+        parser.error("--batch must be at least 1")
+
     logging.basicConfig(format=("%(levelname)s: "
                                 + "[%(relativeCreated)d] "
                                 + "%(message)s"),
                         level=opts.loglevel)
 
     if opts.image:
-        code = bytearray(opts.image.read())
+        # Keep the image immutable, as all sessions share it
+        code = opts.image.read()
         opts.image.close()
         if os.path.splitext(opts.image.name)[1] in (".hex", ".ihx"):
-            code = hex2bin(code)
+            code = bytes(hex2bin(bytearray(code)))
     else:
         code = None
 
@@ -692,9 +813,73 @@ def main():
     with serial.Serial(port=opts.port,
                        baudrate=opts.lowbaud,
                        parity=serial.PARITY_NONE) as conn:
-        if opts.aispmagic:
-            autoisp(conn, opts.aispbaud, opts.aispmagic)
-        program(Programmer(conn, opts.protocol), code, opts.erase_eeprom)
+        if opts.aispmagic or opts.aispreset:
+            aisp = lambda prog: autoisp(prog,
+                                        opts.aispbaud,
+                                        opts.aispmagic,
+                                        opts.aispreset,
+                                        opts.aispretry,
+                                        opts.aispwait)
+        else:
+            aisp = None
+
+        # Measure the Python heap used by each session
+        tracing = (tracemalloc is not None
+                   and hasattr(tracemalloc, "reset_peak")
+                   and logging.getLogger().isEnabledFor(logging.INFO))
+        if tracing:
+            tracemalloc.start()
+
+        total = 0
+        failed = 0
+
+        for i in range(opts.batch):
+            if opts.batch > 1:
+                if i > 0:
+                    # Do not reset or detect the target just programmed
+                    sys.stdout.write("Insert next target and press Enter")
+                    sys.stdout.flush()
+                    if not sys.stdin.readline():
+                        print("")
+                        break
+
+                print("Target %d of %d" % (i + 1, opts.batch))
+
+            # The previous session leaves the port at its fast baudrate
+            conn.baudrate = opts.lowbaud
+            conn.flushInput()
+
+            total += 1
+            t = time.time()
+            if tracing:
+                tracemalloc.reset_peak()
+                heap = tracemalloc.get_traced_memory()[0]
+            try:
+                program(Programmer(conn, opts.protocol), code,
+                        opts.erase_eeprom, aisp, opts.options_only)
+            except (IOError, AssertionError, serial.SerialException) as e:
+                if opts.batch == 1:
+                    raise
+                logging.info("Target %d failed" % (i + 1), exc_info=True)
+                print(" failed: %s" % (str(e) or type(e).__name__))
+                failed += 1
+            else:
+                if opts.batch > 1:
+                    print("Finished in %.1fs" % (time.time() - t))
+            finally:
+                if tracing:
+                    peak = tracemalloc.get_traced_memory()[1] - heap
+                    logging.info("Session memory: %d bytes (Python heap peak)"
+                                 % peak)
+
+        if opts.batch > 1:
+            print("%d of %d targets done" % (total - failed, total))
+
+    if maxrss() is not None:
+        logging.info("Peak process memory: %d KB" % maxrss())
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":